@@ -0,0 +1,95 @@
+"""
+Бэкенды транскрибации (Whisper).
+
+Нужный бэкенд выбирается при старте бота переменной WHISPER_BACKEND:
+  fal   — fal.ai (аудио загружается в хранилище fal), по умолчанию
+  local — faster-whisper (CTranslate2) на CPU/GPU
+  jax   — whisper-jax (JAX/XLA, GPU/TPU)
+  rbln  — модель, скомпилированная под NPU Rebellions (optimum-rbln)
+
+Тяжёлые зависимости импортируются только для выбранного бэкенда.
+Аудио передаётся в бэкенд байтами, без временных файлов на диске.
+Бэкенд может дополнительно реализовать stream() — выдачу текста по сегментам
+по мере распознавания (см. stream_segments).
+"""
+import asyncio
+import contextlib
+import functools
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import AsyncIterator, Protocol
+
+# Отдельный ограниченный пул для блокирующих вызовов (модели, sqlite),
+# чтобы они не выедали общий пул asyncio.to_thread
+BLOCKING_POOL = ThreadPoolExecutor(max_workers=16, thread_name_prefix="blocking")
+
+
+async def run_blocking(fn, *args, **kwargs):
+    """Выполнить блокирующую функцию в BLOCKING_POOL."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(BLOCKING_POOL, functools.partial(fn, *args, **kwargs))
+
+
+class WhisperBackend(Protocol):
+    async def transcribe(self, audio: bytes, content_type: str, language: str) -> str:
+        """Вернуть распознанный текст аудио (content_type — MIME-тип, например audio/ogg)."""
+        ...
+
+
+async def stream_segments(
+    backend: WhisperBackend,
+    audio: bytes,
+    content_type: str,
+    language: str
+) -> AsyncIterator[str]:
+    """
+    Текст по сегментам по мере распознавания.
+    Бэкенды без stream() отдают весь текст одним сегментом.
+    """
+    stream = getattr(backend, 'stream', None)
+    if stream is None:
+        text = await backend.transcribe(audio, content_type, language)
+        if text:
+            yield text
+        return
+
+    # aclosing — чтобы при досрочном выходе бэкенд сразу освободил модель
+    async with contextlib.aclosing(stream(audio, content_type, language)) as segments:
+        async for segment in segments:
+            yield segment
+
+
+def make_backend(name: str) -> WhisperBackend:
+    """
+    Создать бэкенд по имени (значение WHISPER_BACKEND).
+    Настройки у каждого бэкенда свои: WHISPER_* — local, JAX_* — jax, RBLN_* — rbln.
+    """
+    if name == 'fal':
+        from .fal_backend import FalBackend
+        return FalBackend()
+
+    if name == 'local':
+        from .faster_whisper_backend import FasterWhisperBackend
+        return FasterWhisperBackend(
+            os.getenv('WHISPER_MODEL', 'large-v3'),
+            device=os.getenv('WHISPER_DEVICE', 'cpu'),
+            compute_type=os.getenv('WHISPER_COMPUTE_TYPE', 'int8')
+        )
+
+    if name == 'jax':
+        from .whisper_jax_backend import WhisperJaxBackend
+        return WhisperJaxBackend(
+            os.getenv('JAX_MODEL', 'openai/whisper-large-v3'),
+            batch_size=int(os.getenv('JAX_BATCH_SIZE', '16'))
+        )
+
+    if name == 'rbln':
+        from .rbln_backend import RblnBackend
+        return RblnBackend(
+            os.getenv('RBLN_MODEL_PATH', 'rbln-whisper-large-v3'),
+            processor_id=os.getenv('RBLN_PROCESSOR', 'openai/whisper-large-v3'),
+            # Должен совпадать с batch size, под который скомпилирована модель
+            batch_size=int(os.getenv('RBLN_BATCH_SIZE', '1'))
+        )
+
+    raise ValueError(f"Неизвестный WHISPER_BACKEND: {name!r} (ожидается fal, local, jax или rbln)")
@@ -0,0 +1,25 @@
+import asyncio
+
+import fal_client
+
+
+class FalBackend:
+    """Транскрибация через fal-ai/whisper: аудио загружается в хранилище fal прямо из памяти."""
+
+    def __init__(self, max_uploads: int = 8):
+        # Ограничиваем число одновременных загрузок, чтобы не забить исходящий канал
+        self.upload_semaphore = asyncio.Semaphore(max_uploads)
+
+    async def transcribe(self, audio: bytes, content_type: str, language: str) -> str:
+        async with self.upload_semaphore:
+            audio_url = await fal_client.upload_async(audio, content_type)
+        result = await fal_client.subscribe_async(
+            "fal-ai/whisper",
+            arguments={
+                "audio_url": audio_url,
+                "task": "transcribe",
+                "language": language
+            },
+            with_logs=False
+        )
+        return result.get('text') if result else None
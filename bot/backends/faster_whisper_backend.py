@@ -0,0 +1,57 @@
+import asyncio
+import io
+import threading
+from typing import AsyncIterator, Iterator
+
+from faster_whisper import WhisperModel
+
+from . import run_blocking
+
+
+class FasterWhisperBackend:
+    """Локальная транскрибация через faster-whisper (CTranslate2, по умолчанию int8)."""
+
+    def __init__(self, model: str, device: str = 'cpu', compute_type: str = 'int8'):
+        self.model = WhisperModel(model, device=device, compute_type=compute_type)
+        # CTranslate2 сам занимает все ядра — параллельные транскрибации только мешают друг другу
+        self.semaphore = asyncio.Semaphore(1)
+
+    def _iter_segments(self, audio: bytes, language: str) -> Iterator[str]:
+        # Сегменты генерируются лениво: распознавание идёт по мере итерации
+        segments, _ = self.model.transcribe(io.BytesIO(audio), language=language, vad_filter=True)
+        for segment in segments:
+            yield segment.text
+
+    def _transcribe_sync(self, audio: bytes, language: str) -> str:
+        return " ".join(text.strip() for text in self._iter_segments(audio, language))
+
+    async def transcribe(self, audio: bytes, content_type: str, language: str) -> str:
+        async with self.semaphore:
+            return await run_blocking(self._transcribe_sync, audio, language)
+
+    async def stream(self, audio: bytes, content_type: str, language: str) -> AsyncIterator[str]:
+        """Отдавать сегменты по мере распознавания (модель крутится в рабочем потоке)."""
+        loop = asyncio.get_running_loop()
+        segments: asyncio.Queue = asyncio.Queue()
+        stopped = threading.Event()
+
+        def produce():
+            try:
+                for text in self._iter_segments(audio, language):
+                    if stopped.is_set():
+                        break
+                    loop.call_soon_threadsafe(segments.put_nowait, text)
+            finally:
+                loop.call_soon_threadsafe(segments.put_nowait, None)
+
+        async with self.semaphore:
+            worker = asyncio.ensure_future(run_blocking(produce))
+            try:
+                while (text := await segments.get()) is not None:
+                    yield text
+                # Пробрасываем ошибку распознавания, если она была
+                await worker
+            finally:
+                # Потребитель мог уйти раньше — останавливаем поток и ждём его, не занимая модель дважды
+                stopped.set()
+                await asyncio.gather(worker, return_exceptions=True)
@@ -0,0 +1,32 @@
+import asyncio
+
+from optimum.rbln import RBLNWhisperForConditionalGeneration
+from transformers import AutoProcessor, pipeline
+
+from . import run_blocking
+
+
+class RblnBackend:
+    """Транскрибация моделью, заранее скомпилированной под NPU Rebellions (optimum-rbln)."""
+
+    def __init__(self, model_path: str, processor_id: str, batch_size: int = 1):
+        processor = AutoProcessor.from_pretrained(processor_id)
+        model = RBLNWhisperForConditionalGeneration.from_pretrained(model_path, export=False)
+        self.pipeline = pipeline(
+            "automatic-speech-recognition",
+            model=model,
+            tokenizer=processor.tokenizer,
+            feature_extractor=processor.feature_extractor,
+            chunk_length_s=30,
+            batch_size=batch_size
+        )
+        self.semaphore = asyncio.Semaphore(1)
+
+    async def transcribe(self, audio: bytes, content_type: str, language: str) -> str:
+        async with self.semaphore:
+            result = await run_blocking(
+                self.pipeline,
+                audio,  # байты декодирует сам pipeline (через ffmpeg)
+                generate_kwargs={"language": language, "task": "transcribe"}
+            )
+        return result.get('text')
@@ -0,0 +1,26 @@
+import asyncio
+
+import jax.numpy as jnp
+from whisper_jax import FlaxWhisperPipline
+
+from . import run_blocking
+
+
+class WhisperJaxBackend:
+    """Транскрибация через whisper-jax: батчевые XLA-ядра на GPU/TPU."""
+
+    def __init__(self, model: str, batch_size: int = 16):
+        self.pipeline = FlaxWhisperPipline(model, dtype=jnp.bfloat16, batch_size=batch_size)
+        # Один ускоритель — одна задача; батчинг чанков делает сам pipeline
+        self.semaphore = asyncio.Semaphore(1)
+
+    async def transcribe(self, audio: bytes, content_type: str, language: str) -> str:
+        async with self.semaphore:
+            # Первый вызов компилирует модель (JIT), дальше используется кэш XLA
+            result = await run_blocking(
+                self.pipeline,
+                audio,  # байты декодирует сам pipeline (через ffmpeg)
+                task="transcribe",
+                language=language
+            )
+        return result.get('text')
@@ -1,18 +1,27 @@
 import os
 import asyncio
+import contextlib
+import functools
+import io
 import logging
-import ffmpeg
 from pathlib import Path
 from datetime import datetime
 from aiogram import Bot, Dispatcher, types, F
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
 from aiogram.filters.command import Command
 from dotenv import load_dotenv
-from transfer_sh_client.manager import TransferManager
-import fal_client
+import httpx
 import openai
-import tempfile
-from collections import defaultdict
-from typing import Dict, Set
+import orjson
+import time
+from aiolimiter import AsyncLimiter
+from collections import Counter
+from typing import Awaitable, Callable, Dict, Optional, Set, Tuple
+from backends import make_backend, run_blocking, stream_segments
+from result_cache import (
+    data_hash, get_formatted, get_transcript, put_formatted, put_transcript, text_hash
+)
 
 # === ЗАГРУЗКА ОКРУЖЕНИЯ ===
 load_dotenv()
@@ -21,27 +30,89 @@ load_dotenv()
 logging.basicConfig(level=logging.INFO)
 
 # === ИНИЦИАЛИЗАЦИЯ БОТА ===
-bot = Bot(token=os.getenv('BOT_TOKEN'))
+# orjson вместо json — каждый апдейт и ответ Telegram API разбирается заметно быстрее
+bot = Bot(
+    token=os.getenv('BOT_TOKEN'),
+    session=AiohttpSession(
+        api=TelegramAPIServer.from_base("https://api.telegram.org"),
+        json_loads=orjson.loads,
+        json_dumps=lambda obj: orjson.dumps(obj).decode(),
+    ),
+)
 dp = Dispatcher()
 
-# === ТАБЛИЦА ЗАДАЧ ДЛЯ КАЖДОГО ЮЗЕРА ===
-user_tasks: Dict[int, Set[asyncio.Task]] = defaultdict(set)
-
-# === КЛИЕНТЫ ДЛЯ transfer.sh и OpenRouter ===
-transfer_manager = TransferManager(
-    os.getenv('TRANSFER_SH_HOST'),
-    os.getenv('TRANSFER_SH_LOGIN'),
-    os.getenv('TRANSFER_SH_PASSWORD')
+# === АКТИВНЫЕ ЗАДАЧИ ===
+# Сколько задач сейчас выполняется у каждого юзера
+active_count: Counter[int] = Counter()
+# Сильные ссылки на задачи: event loop держит только слабые, без этого задача может пропасть
+background_tasks: Set[asyncio.Task] = set()
+
+# === БЭКЕНД ТРАНСКРИБАЦИИ (fal | local | jax | rbln) ===
+BACKEND = make_backend(os.getenv('WHISPER_BACKEND', 'fal'))
+
+# Не больше 4 транскрибаций одновременно — остальные ждут в очереди
+TRANSCRIBE_SEM = asyncio.Semaphore(4)
+
+# === ОБЩИЙ HTTP-ПУЛ ===
+# Одно долгоживущее соединение на хост (HTTP/2, keep-alive) — без TLS-рукопожатия на каждый запрос.
+# Закрывается при остановке бота (см. _main).
+HTTPX = httpx.AsyncClient(
+    limits=httpx.Limits(max_connections=200, max_keepalive_connections=50),
+    http2=True,
+    timeout=httpx.Timeout(60.0),
 )
 
-openai_client = openai.OpenAI(
+# === КЛИЕНТ ДЛЯ OpenRouter ===
+# Асинхронный клиент: запросы идут прямо через event loop (без to_thread), поверх общего пула HTTPX
+openai_client = openai.AsyncOpenAI(
     base_url=os.getenv('OPENROUTER_BASE_URL'),
     api_key=os.getenv('OPENROUTER_API_KEY'),
+    http_client=HTTPX,
 )
 
+# === ЛИМИТ ИСХОДЯЩИХ ЗАПРОСОВ К TELEGRAM ===
+# Telegram допускает ~30 сообщений в секунду на бота; держимся чуть ниже, чтобы не ловить 429
+TG_LIMITER = AsyncLimiter(28, 1.0)
+
+# Время последней правки каждого сообщения: (chat_id, message_id) -> time.monotonic()
+last_edit_ts: Dict[Tuple[int, int], float] = {}
+
 # === КОНСТАНТЫ ===
 MAX_MESSAGE_LENGTH = 3990
-TOTAL_STEPS = 4
+# Шагов прогресса: 1 — распознавание и форматирование, 2 — завершение.
+# Каждая правка расходует токен из общего лимита Telegram, поэтому их минимум.
+TOTAL_STEPS = 2
+# Правки прогресса чаще этого интервала пропускаются (Telegram — ~1 сообщение в секунду на чат)
+PROGRESS_DEBOUNCE_SECONDS = 1.0
+# Распознанный текст отправляется на форматирование кусками не меньше этого размера
+FORMAT_PIECE_SIZE = 1200
+# Текст короче этого — один абзац, форматировать через LLM нечего
+FORMAT_MIN_LENGTH = 400
+# Модели форматирования: основная и запасная
+FORMAT_MODELS = ("google/gemini-2.0-flash-exp:free", "google/gemini-flash-1.5")
+# Сколько ждать ответа (или первого куска стрима) основной модели, прежде чем параллельно звать запасную
+FORMAT_HEDGE_DELAY = 0.5
+# Превью в progress-сообщении обновляется, когда готовый текст вырос хотя бы на столько символов
+PREVIEW_STEP = 2000
+# Сколько сегментов распознавания может ждать форматирования
+SEGMENT_QUEUE_SIZE = 64
+# Размер куска при скачивании из Telegram (по умолчанию в aiogram — 64 КБ)
+DOWNLOAD_CHUNK_SIZE = 1 << 20
+
+# Поддерживаемые форматы аудио и их MIME-типы (для загрузки в бэкенд)
+AUDIO_CONTENT_TYPES = {
+    'mp3': 'audio/mpeg',
+    'wav': 'audio/wav',
+    'ogg': 'audio/ogg',
+    'm4a': 'audio/mp4',
+}
+
+FORMAT_PROMPT = (
+    "Пожалуйста, разбей текст пользователя на логические параграфы "
+    "для улучшения читаемости. Сохрани исходное содержание полностью, "
+    "добавь только переносы строк. "
+    "Не добавляй никаких дополнительных слов или пунктуации."
+)
 
 HELP_MESSAGE = """
 🎙 Я помогаю преобразовывать голосовые и аудио сообщения в текст с умным форматированием.
@@ -63,29 +134,70 @@ HELP_MESSAGE = """
 # ВСПОМОГАТЕЛЬНЫЕ ФУНКЦИИ
 # =======================================================================
 
-async def cleanup_task(user_id: int, task: asyncio.Task):
-    """Удалить задачу из списка активных после завершения (успешного или с ошибкой)."""
-    try:
-        await task
-    except Exception as e:
-        logging.error(f"Task error for user {user_id}: {str(e)}")
-    finally:
-        user_tasks[user_id].discard(task)
-        if not user_tasks[user_id]:
-            del user_tasks[user_id]
+def _release_slot(user_id: int):
+    """Вернуть юзеру один слот параллельной обработки."""
+    active_count[user_id] -= 1
+    if active_count[user_id] <= 0:
+        del active_count[user_id]
+
+
+def on_task_done(user_id: int, task: asyncio.Task):
+    """Освободить слот юзера после завершения задачи (успешного или с ошибкой)."""
+    background_tasks.discard(task)
+    _release_slot(user_id)
+    if not task.cancelled() and task.exception() is not None:
+        logging.error(f"Task error for user {user_id}: {str(task.exception())}")
+
+
+async def safe_edit(message: types.Message, text: str, debounce: bool = False):
+    """
+    Отредактировать сообщение с учётом общего лимита TG_LIMITER.
+    debounce=True — для промежуточного прогресса: правка пропускается,
+    если с предыдущей прошло меньше PROGRESS_DEBOUNCE_SECONDS.
+    """
+    key = (message.chat.id, message.message_id)
+    now = time.monotonic()
+    if debounce and now - last_edit_ts.get(key, 0.0) < PROGRESS_DEBOUNCE_SECONDS:
+        return
+    last_edit_ts[key] = now
+    async with TG_LIMITER:
+        return await message.edit_text(text)
+
+
+async def safe_answer(message: types.Message, text: str) -> types.Message:
+    """Отправить сообщение в чат с учётом общего лимита TG_LIMITER."""
+    async with TG_LIMITER:
+        return await message.answer(text)
+
+
+async def safe_reply(message: types.Message, text: str) -> types.Message:
+    """Ответить на сообщение с учётом общего лимита TG_LIMITER."""
+    async with TG_LIMITER:
+        return await message.reply(text)
 
 
 def chunk_text(text: str, max_size: int = MAX_MESSAGE_LENGTH) -> list[str]:
     """
     Безопасное разбиение текста на части, чтобы не превышать лимит Telegram (4096 символов).
-    Разбивает «жёстко» по max_size. Если хочется по предложениям/абзацам – можно добавить доп.логику.
+    Режем по последней границе абзаца, затем строки, затем предложения перед max_size,
+    и только если таких нет — «жёстко» по max_size.
     """
     chunks = []
-    start = 0
-    while start < len(text):
-        end = start + max_size
-        chunks.append(text[start:end])
-        start = end
+    while len(text) > max_size:
+        idx = text.rfind("\n\n", 0, max_size)
+        if idx <= 0:
+            idx = text.rfind("\n", 0, max_size)
+        if idx <= 0:
+            idx = text.rfind(". ", 0, max_size - 1)
+            # точку оставляем в конце текущей части
+            idx = idx + 1 if idx > 0 else -1
+        if idx <= 0:
+            idx = max_size
+        if text[:idx].strip():
+            chunks.append(text[:idx])
+        text = text[idx:].lstrip()
+    if text:
+        chunks.append(text)
     return chunks
 
 
@@ -118,162 +230,314 @@ async def send_long_text_as_messages(
 
         # Первую часть пытаемся сделать edit_text — чтобы обновить progress_message
         if i == 0:
-            await message.edit_text(chunk_to_send)
+            await safe_edit(message, chunk_to_send)
         else:
             # Остальные части отправляем новыми сообщениями
-            await message.answer(chunk_to_send)
+            await safe_answer(message, chunk_to_send)
 
 
-async def download_telegram_file(file: types.File, destination: str):
-    """Скачать файл из Telegram в локальный путь."""
-    await bot.download_file(file.file_path, destination)
+async def download_telegram_file(file: types.Downloadable) -> bytes:
+    """Скачать файл из Telegram в память (без временного файла на диске)."""
+    buffer = io.BytesIO()
+    await bot.download(file, destination=buffer, chunk_size=DOWNLOAD_CHUNK_SIZE)
+    return buffer.getvalue()
 
 
-async def get_file_extension(file_path: str) -> str:
-    """Получить расширение аудио-файла через ffmpeg.probe (асинхронно через to_thread)."""
-    try:
-        probe = await asyncio.to_thread(ffmpeg.probe, file_path)
-        # format_name может быть списком через запятую, берём первый
-        return probe['format']['format_name'].split(',')[0].lower()
-    except ffmpeg.Error:
-        return None
+def get_file_extension(data: bytes) -> Optional[str]:
+    """Получить расширение аудио по сигнатуре в начале файла (без запуска ffmpeg)."""
+    head = data[:12]
+    if head.startswith(b"OggS"):
+        return 'ogg'
+    if head[:3] == b"ID3" or head[:2] in (b"\xff\xfb", b"\xff\xf3", b"\xff\xf2"):
+        return 'mp3'
+    if head[:4] == b"RIFF" and head[8:12] == b"WAVE":
+        return 'wav'
+    if head[4:8] == b"ftyp":
+        return 'm4a'
+    return None
+
+
+def needs_formatting(text: str) -> bool:
+    """Нужен ли вызов LLM: короткий текст разбивать на абзацы незачем."""
+    return len(text) >= FORMAT_MIN_LENGTH
 
 
-async def try_format_with_openai(text: str) -> str:
+async def try_format_with_openai(
+    text: str,
+    on_partial: Optional[Callable[[str], Awaitable[None]]] = None
+) -> str:
     """
-    Пытаемся «пробить» форматирование текста через OpenRouter на двух моделях:
-      1) google/gemini-2.0-flash-exp:free
-      2) при ошибке -> google/gemini-flash-1.5
-    Если обе попытки не сработали — пробрасываем исключение.
+    Форматирование текста с кэшем: уже встречавшийся текст (sha256) берём из кэша,
+    иначе идём в OpenRouter (см. _format_with_models) и запоминаем результат.
+    on_partial — если задан, ответ модели стримится и колбэк получает накопленный текст.
+    Короткий текст (см. needs_formatting) возвращается как есть.
     """
-    messages = [
-        {
-            "role": "user",
-            "content": (
-                "Пожалуйста, разбей следующий текст на логические параграфы "
-                "для улучшения читаемости. Сохрани исходное содержание полностью, "
-                "добавь только переносы строк. "
-                "Не добавляй никаких дополнительных слов или пунктуации.\n\n"
-                f"Текст: {text}"
-            )
-        }
-    ]
-
-    # Модель 1
-    try:
-        completion = await asyncio.to_thread(
-            openai_client.chat.completions.create,
-            model="google/gemini-2.0-flash-exp:free",
+    if not needs_formatting(text):
+        logging.info("Форматирование пропущено: короткий текст (%d символов)", len(text))
+        return text
+
+    key = text_hash(text)
+    # Чтение тоже в пуле: на промахе оно ждёт _lock, который держит чужой commit() с fsync
+    cached = await run_blocking(get_formatted, key)
+    if cached is not None:
+        return cached
+
+    formatted = await _format_with_models(text, on_partial)
+    if formatted:
+        await run_blocking(put_formatted, key, formatted)
+    return formatted
+
+
+async def _complete(
+    model: str,
+    messages: list[dict],
+    on_partial: Optional[Callable[[str], Awaitable[None]]] = None
+) -> str:
+    """Один запрос к модели; с on_partial — потоковый (stream=True)."""
+    if on_partial is None:
+        completion = await openai_client.chat.completions.create(
+            model=model,
             messages=messages,
             temperature=0.2,
             max_tokens=8000,
             stream=False
         )
-        return completion.choices[0].message.content
-    except Exception as e:
-        # raise e
-        logging.warning("Первая модель упала с ошибкой: %s", str(e))
-
-    # Модель 2
+        content = completion.choices[0].message.content
+        if not content:
+            raise Exception(f"Модель {model} вернула пустой ответ.")
+        return content
+
+    stream = await openai_client.chat.completions.create(
+        model=model,
+        messages=messages,
+        temperature=0.2,
+        max_tokens=8000,
+        stream=True
+    )
+    content = ""
+    async for chunk in stream:
+        if chunk.choices and chunk.choices[0].delta.content:
+            content += chunk.choices[0].delta.content
+            await on_partial(content)
+    # Пустой ответ — не победа в гонке: пусть отработает другая модель или ветка ошибки
+    if not content:
+        raise Exception(f"Модель {model} вернула пустой ответ.")
+    return content
+
+
+async def _format_with_models(
+    text: str,
+    on_partial: Optional[Callable[[str], Awaitable[None]]] = None
+) -> str:
+    """
+    Пытаемся «пробить» форматирование текста через OpenRouter на двух моделях (FORMAT_MODELS):
+      1) google/gemini-2.0-flash-exp:free — сразу
+      2) google/gemini-flash-1.5 — параллельно, если первая за FORMAT_HEDGE_DELAY
+         не ответила и не начала стримить, либо сразу после её ошибки
+    Берём первый успешный ответ, оставшийся запрос отменяем.
+    Если обе попытки не сработали — пробрасываем исключение.
+    """
+    # Системный промпт одинаков побайтно во всех запросах — срабатывает кэш префикса у провайдера
+    messages = [
+        {"role": "system", "content": FORMAT_PROMPT},
+        {"role": "user", "content": text}
+    ]
+    primary_model, backup_model = FORMAT_MODELS
+
+    # Превью показываем только от одной модели — той, что первой начала стримить
+    owner = None
+    first_chunk = asyncio.Event()
+
+    def forward_partials(model: str):
+        if on_partial is None:
+            return None
+
+        async def forward(content: str):
+            nonlocal owner
+            if model == primary_model:
+                first_chunk.set()
+            if owner is None:
+                owner = model
+            if owner == model:
+                await on_partial(content)
+        return forward
+
+    primary = asyncio.create_task(
+        _complete(primary_model, messages, forward_partials(primary_model))
+    )
+    chunk_waiter = asyncio.create_task(first_chunk.wait())
+    tasks = {primary: primary_model}
     try:
-        completion = await asyncio.to_thread(
-            openai_client.chat.completions.create,
-            model="google/gemini-flash-1.5",
-            messages=messages,
-            temperature=0.2,
-            max_tokens=8000,
-            stream=False
+        await asyncio.wait(
+            {primary, chunk_waiter},
+            timeout=FORMAT_HEDGE_DELAY,
+            return_when=asyncio.FIRST_COMPLETED
         )
-        return completion.choices[0].message.content
-    except Exception as e:
-        logging.error("Вторая модель тоже упала с ошибкой: %s", str(e))
-        raise e
+        if first_chunk.is_set() and not primary.done():
+            # Первая модель уже отвечает — вторая нужна, только если она упадёт
+            await asyncio.wait({primary})
+        if not primary.done() or primary.exception() is not None:
+            backup = asyncio.create_task(
+                _complete(backup_model, messages, forward_partials(backup_model))
+            )
+            tasks[backup] = backup_model
+
+        error = None
+        pending = set(tasks)
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    return task.result()
+                error = task.exception()
+                logging.warning("Модель %s упала с ошибкой: %s", tasks[task], str(error))
+                if owner == tasks[task]:
+                    owner = None
+
+        logging.error("Обе модели упали, последняя ошибка: %s", str(error))
+        raise error
+    finally:
+        chunk_waiter.cancel()
+        for task in tasks:
+            task.cancel()
 
 
 # =======================================================================
 # ОСНОВНАЯ ЛОГИКА ОБРАБОТКИ АУДИО
 # =======================================================================
 
-async def process_audio_file(file_path: str, progress_message: types.Message):
-    """
-    Общий конвейер:
-    1. Загрузка на transfer.sh
-    2. Транскрибация через fal_client
-    3. Форматирование (OpenRouter)
-    4. Отправка результата
-    """
-    try:
-        # Шаг 1: загрузка на transfer.sh
-        await progress_message.edit_text(
-            "🔄 Загрузка файла на сервер... (1/4)\n"
-            "└ Подготовка файла для обработки"
-        )
-        download_link = await asyncio.to_thread(
-            transfer_manager.upload,
-            file_path=file_path,
-            max_downloads=2
-        )
+RESULT_HEADER = "✨ Готово! Вот ваш отформатированный текст:\n\n"
+PREVIEW_HEADER = f"🔄 Обработка аудио... (1/{TOTAL_STEPS})\n└ Уже готово:\n\n"
 
-        # Шаг 2: транскрибация через fal_client
-        await progress_message.edit_text(
-            "🎯 Транскрибация аудио... (2/4)\n"
-            "└ Преобразование речи в текст"
-        )
-        # Если fal_client.subscribe — обычная (синхронная) функция, используем to_thread:
-        result = await asyncio.to_thread(
-            fal_client.subscribe,
-            "fal-ai/whisper",
-            arguments={
-                "audio_url": download_link,
-                "task": "transcribe",
-                "language": "ru"
-            }
-        )
 
-        if not result or not result.get('text'):
-            raise Exception("Не удалось получить текст из аудио.")
+def preview_text(text: str) -> str:
+    """Текст для progress-сообщения с готовой частью; длинный текст обрезаем с начала."""
+    limit = MAX_MESSAGE_LENGTH - len(PREVIEW_HEADER) - 1
+    if len(text) > limit:
+        text = "…" + text[-limit:]
+    return PREVIEW_HEADER + text
 
-        raw_text = result['text']
 
-        # Шаг 3: улучшение форматирования (OpenRouter)
-        await progress_message.edit_text(
-            "📝 Форматирование текста... (3/4)\n"
-            "└ Улучшение читаемости текста"
-        )
+async def produce_segments(audio: bytes, content_type: str, segments: asyncio.Queue):
+    """Транскрибация в очередь segments по сегментам; None в конце — признак конца потока."""
+    try:
+        async with TRANSCRIBE_SEM, contextlib.aclosing(
+            stream_segments(BACKEND, audio, content_type, "ru")
+        ) as stream:
+            async for segment in stream:
+                await segments.put(segment)
+    except Exception:
+        await segments.put(None)
+        raise
+    await segments.put(None)
+
+
+async def process_audio_file(
+    audio: bytes,
+    content_type: str,
+    progress_message: types.Message,
+    audio_hash: str
+):
+    """
+    Общий конвейер (два шага прогресса):
+    1. Транскрибация выбранным бэкендом (см. backends, WHISPER_BACKEND) и форматирование
+       (OpenRouter) кусками по мере распознавания, с превью в progress_message
+    2. Форматирование остатка, отправка результата (и сохранение в кэш по audio_hash)
+    """
+    # Транскрибация в фоне, сегменты приходят в очередь
+    segments: asyncio.Queue = asyncio.Queue(maxsize=SEGMENT_QUEUE_SIZE)
+    producer = asyncio.create_task(produce_segments(audio, content_type, segments))
+
+    raw_parts = []
+    formatted_parts = []
+    shown = 0  # длина превью при последней правке
+
+    async def show_preview(partial: str = ""):
+        nonlocal shown
+        preview = "\n\n".join(formatted_parts + ([partial] if partial else []))
+        if len(preview) - shown < PREVIEW_STEP:
+            return
+        shown = len(preview)
+        # Превью косметическое: ошибка Telegram (429, «message is not modified» и т.п.)
+        # не должна считаться ошибкой модели и срывать форматирование
         try:
-            formatted_text = await try_format_with_openai(raw_text)
+            await safe_edit(progress_message, preview_text(preview), debounce=True)
+        except Exception as e:
+            logging.warning("Не удалось обновить превью: %s", str(e))
+
+    async def format_piece(piece: str):
+        try:
+            formatted_parts.append(await try_format_with_openai(piece, on_partial=show_preview))
         except Exception as format_err:
             # Если обе модели упали
             raise Exception(
                 "Ошибка при форматировании текста (оба варианта не сработали). "
                 f"Детали: {str(format_err)}"
             )
+        await show_preview()
 
-        # Шаг 4: отправляем результат
-        await progress_message.edit_text(
-            "✨ Завершающий этап... (4/4)\n"
-            "└ Подготовка результата"
+    try:
+        # Шаг 1: форматируем накопленный текст, пока распознаётся следующий
+        await safe_edit(
+            progress_message,
+            f"🔄 Обработка аудио... (1/{TOTAL_STEPS})\n"
+            "└ Распознавание и форматирование текста",
+            debounce=True
         )
 
+        pending = ""
+        while (segment := await segments.get()) is not None:
+            raw_parts.append(segment)
+            pending += segment
+            if len(pending) >= FORMAT_PIECE_SIZE:
+                await format_piece(pending.strip())
+                pending = ""
+
+        # Ошибка распознавания (если была) пробрасывается здесь
+        await producer
+
+        raw_text = "".join(raw_parts).strip()
+        if not raw_text:
+            raise Exception("Не удалось получить текст из аудио.")
+
+        # Шаг 2: форматируем остаток и отправляем результат.
+        # Если остаток короткий, LLM не вызывается и результат уходит сразу — отдельная правка не нужна
+        if needs_formatting(pending.strip()):
+            await safe_edit(
+                progress_message,
+                f"✨ Завершающий этап... ({TOTAL_STEPS}/{TOTAL_STEPS})\n"
+                "└ Форматирование и подготовка результата",
+                debounce=True
+            )
+
+        if pending.strip():
+            await format_piece(pending.strip())
+        formatted_text = "\n\n".join(formatted_parts)
+
+        await run_blocking(put_transcript, audio_hash, raw_text, formatted_text)
+
         await send_long_text_as_messages(
             progress_message,
             formatted_text,
-            initial_text="✨ Готово! Вот ваш отформатированный текст:\n\n"
+            initial_text=RESULT_HEADER
         )
 
     except Exception as e:
         logging.error(f"Error processing audio: {str(e)}")
-        await progress_message.edit_text(
+        await safe_edit(
+            progress_message,
             f"❌ Произошла ошибка при обработке:\n└ {str(e)}"
         )
 
+    finally:
+        # Забираем результат продюсера, чтобы его ошибка не ушла в «Task exception was never retrieved»
+        producer.cancel()
+        await asyncio.gather(producer, return_exceptions=True)
+
 
 async def process_audio_message(message: types.Message, progress_message: types.Message):
     """Логика подготовки файла и вызова process_audio_file."""
-    temp_file = None
     try:
-        temp_file = tempfile.NamedTemporaryFile(delete=False)
-        
         # Извлекаем правильный file из объекта message
         if message.voice:
             tg_file = message.voice
@@ -284,31 +548,36 @@ async def process_audio_message(message: types.Message, progress_message: types.
         else:
             raise ValueError("Неподдерживаемый тип вложения.")
 
-        # Получаем file info
-        file_info = await bot.get_file(tg_file.file_id)
-
-        # Скачиваем
-        await download_telegram_file(file_info, temp_file.name)
+        # Скачиваем в память
+        audio = await download_telegram_file(tg_file)
+
+        # Такой же файл уже обрабатывали (например, пересланное голосовое) — отдаём из кэша
+        # hashlib отпускает GIL на больших буферах — считаем в пуле, не блокируя event loop
+        audio_hash = await run_blocking(data_hash, audio)
+        cached = await run_blocking(get_transcript, audio_hash)
+        if cached is not None:
+            _, formatted_text = cached
+            await send_long_text_as_messages(
+                progress_message,
+                formatted_text,
+                initial_text=RESULT_HEADER
+            )
+            return
 
         # Проверяем формат (mp3, wav, ogg, m4a)
-        extension = await get_file_extension(temp_file.name)
-        if not extension or extension not in ['mp3', 'wav', 'ogg', 'm4a']:
+        extension = get_file_extension(audio)
+        if not extension or extension not in AUDIO_CONTENT_TYPES:
             raise ValueError("Файл должен быть аудио форматом (mp3, wav, ogg, m4a).")
 
         # Запускаем конвейер обработки
-        await process_audio_file(temp_file.name, progress_message)
+        await process_audio_file(audio, AUDIO_CONTENT_TYPES[extension], progress_message, audio_hash)
 
     except Exception as e:
         logging.error(f"Error handling audio message: {str(e)}")
-        await progress_message.edit_text(f"❌ Ошибка:\n└ {str(e)}")
+        await safe_edit(progress_message, f"❌ Ошибка:\n└ {str(e)}")
 
     finally:
-        # Удаляем временный файл
-        if temp_file:
-            try:
-                os.unlink(temp_file.name)
-            except:
-                pass
+        last_edit_ts.pop((progress_message.chat.id, progress_message.message_id), None)
 
 
 # =======================================================================
@@ -317,7 +586,8 @@ async def process_audio_message(message: types.Message, progress_message: types.
 
 @dp.message(Command("start"))
 async def cmd_start(message: types.Message):
-    await message.answer(
+    await safe_answer(
+        message,
         "👋 Привет! Я бот для транскрибации аудио в текст.\n\n"
         "Просто отправьте мне голосовое сообщение или аудио файл, "
         "и я преобразую его в отформатированный текст.\n\n"
@@ -327,7 +597,7 @@ async def cmd_start(message: types.Message):
 
 @dp.message(Command("help"))
 async def cmd_help(message: types.Message):
-    await message.answer(HELP_MESSAGE)
+    await safe_answer(message, HELP_MESSAGE)
 
 
 # =======================================================================
@@ -339,31 +609,64 @@ async def handle_audio(message: types.Message):
     user_id = message.from_user.id
     
     # Ограничим кол-во параллельных задач (не более 3)
-    if len(user_tasks.get(user_id, set())) >= 3:
-        await message.answer(
+    if active_count[user_id] >= 3:
+        await safe_answer(
+            message,
             "⚠️ У вас уже есть 3 активных задачи обработки.\n"
             "Пожалуйста, дождитесь их завершения."
         )
         return
 
+    # Занимаем слот сразу, до первого await, чтобы параллельные сообщения не проскочили лимит
+    active_count[user_id] += 1
+
     # Создаём сообщение-«reply» к исходному аудио
-    progress_message = await message.reply("⏳ Обработка вашего аудио...")
+    try:
+        progress_message = await safe_reply(message, "⏳ Обработка вашего аудио...")
+    except Exception:
+        _release_slot(user_id)
+        raise
 
-    # Создаём асинхронную задачу
+    # Создаём асинхронную задачу; слот освобождается в on_task_done
     task = asyncio.create_task(process_audio_message(message, progress_message))
-    user_tasks[user_id].add(task)
-
-    # Подключаем cleanup, чтобы после завершения убрать задачу из user_tasks
-    asyncio.create_task(cleanup_task(user_id, task))
+    background_tasks.add(task)
+    task.add_done_callback(functools.partial(on_task_done, user_id))
 
 
 # =======================================================================
 # ЗАПУСК БОТА
 # =======================================================================
 
+async def warm_up_connections():
+    """Заранее открыть соединение с OpenRouter, чтобы первый запрос не платил за TLS."""
+    base_url = os.getenv('OPENROUTER_BASE_URL')
+    if not base_url:
+        return
+    try:
+        await HTTPX.head(base_url)
+    except httpx.HTTPError as e:
+        logging.warning("Не удалось прогреть соединение с OpenRouter: %s", str(e))
+
+
+async def _main():
+    try:
+        await warm_up_connections()
+        await dp.start_polling(bot, skip_updates=True)
+    finally:
+        await HTTPX.aclose()
+        await bot.session.close()
+
+
 def main():
+    # uvloop (libuv) быстрее стандартного event loop; на Windows недоступен — тогда работаем на asyncio
+    try:
+        import uvloop
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    except ImportError:
+        logging.info("uvloop не установлен, используется стандартный event loop")
+
     # Запускаем бота
-    asyncio.run(dp.start_polling(bot, skip_updates=True))
+    asyncio.run(_main())
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,92 @@
+"""
+Кэш результатов обработки: sqlite на диске + LRU в памяти.
+
+Две таблицы:
+  formatted   — sha256 текста -> отформатированный текст (без повторного вызова LLM)
+  transcripts — sha256 аудио-файла -> (сырой текст, отформатированный текст),
+                чтобы одинаковые (пересланные) аудио не транскрибировались заново
+"""
+import functools
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+from typing import Optional, Tuple
+
+CACHE_DB_PATH = os.getenv('CACHE_DB_PATH', '/tmp/fmt_cache.db')
+
+_lock = threading.Lock()
+_db = sqlite3.connect(CACHE_DB_PATH, check_same_thread=False)
+_db.execute(
+    "CREATE TABLE IF NOT EXISTS formatted (hash TEXT PRIMARY KEY, text TEXT NOT NULL)"
+)
+_db.execute(
+    "CREATE TABLE IF NOT EXISTS transcripts "
+    "(hash TEXT PRIMARY KEY, raw TEXT NOT NULL, formatted TEXT NOT NULL, ts INT NOT NULL)"
+)
+_db.commit()
+
+
+def text_hash(text: str) -> str:
+    """sha256 текста в hex — ключ кэша."""
+    return hashlib.sha256(text.encode()).hexdigest()
+
+
+def data_hash(data: bytes) -> str:
+    """sha256 содержимого файла в hex (ключ кэша транскрибаций)."""
+    return hashlib.sha256(data).hexdigest()
+
+
+@functools.lru_cache(maxsize=4096)
+def _load_formatted(key: str) -> str:
+    # Промах — KeyError: lru_cache не запоминает исключения, так что в памяти оседают только попадания
+    with _lock:
+        row = _db.execute("SELECT text FROM formatted WHERE hash = ?", (key,)).fetchone()
+    if row is None:
+        raise KeyError(key)
+    return row[0]
+
+
+def get_formatted(key: str) -> Optional[str]:
+    """Отформатированный текст из кэша или None."""
+    try:
+        return _load_formatted(key)
+    except KeyError:
+        return None
+
+
+def put_formatted(key: str, text: str):
+    """Сохранить отформатированный текст."""
+    with _lock:
+        _db.execute("INSERT OR REPLACE INTO formatted (hash, text) VALUES (?, ?)", (key, text))
+        _db.commit()
+
+
+@functools.lru_cache(maxsize=4096)
+def _load_transcript(key: str) -> Tuple[str, str]:
+    with _lock:
+        row = _db.execute(
+            "SELECT raw, formatted FROM transcripts WHERE hash = ?", (key,)
+        ).fetchone()
+    if row is None:
+        raise KeyError(key)
+    return row
+
+
+def get_transcript(key: str) -> Optional[Tuple[str, str]]:
+    """(сырой текст, отформатированный текст) для хэша аудио или None."""
+    try:
+        return _load_transcript(key)
+    except KeyError:
+        return None
+
+
+def put_transcript(key: str, raw: str, formatted: str):
+    """Сохранить результат обработки аудио."""
+    with _lock:
+        _db.execute(
+            "INSERT OR REPLACE INTO transcripts (hash, raw, formatted, ts) VALUES (?, ?, ?, ?)",
+            (key, raw, formatted, int(time.time()))
+        )
+        _db.commit()